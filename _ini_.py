@@ -1,112 +1,329 @@
 # webhook_orchestrator.py
-# Requisitos: pip install flask pyyaml
+# Requisitos: pip install flask pyyaml (opcional: orjson)
 
-import hmac, hashlib, json, os, subprocess, threading, time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio, functools, hashlib, hmac, json, os, shutil, subprocess, sys, tempfile, threading, time
+from typing import NamedTuple
 from flask import Flask, request, abort
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader   # loader em C (libyaml), bem mais rapido
+except ImportError:
+    from yaml import SafeLoader
+try:
+    from orjson import loads as json_loads   # parser em Rust, 2-5x mais rapido que o json da stdlib
+except ImportError:
+    json_loads = json.loads
 
 # CONFIGURACAO
 REPO_PATH = '/home/usuario/repos/meu-repo'   # caminho local do repo (git clone já feito)
 GIT_BIN = '/usr/bin/git'
 WEBHOOK_SECRET = os.environ.get('GITHUB_WEBHOOK_SECRET', 'troque_isto')
-MAX_WORKERS = 3
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()  # codifica uma vez so
 SCRIPT_DIR = 'scripts'   # relativo ao repo
 CONFIG_FILE = 'orchestrator.yaml'  # no repo, define quais scripts rodar / ordem / timeout
 LOG_DIR = '/home/usuario/logs_orchestrador'
+MAX_PAYLOAD = 25 * 1024 * 1024  # limite de payload do GitHub
+READ_CHUNK = 65536
+DEBOUNCE_SECONDS = 2.0  # pushes dentro desta janela viram uma unica execucao
 
 os.makedirs(LOG_DIR, exist_ok=True)
 
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-lock = threading.Lock()  # evitar pulls concorrentes
+app.config['MAX_CONTENT_LENGTH'] = MAX_PAYLOAD  # werkzeug sempre limita o request.stream
+# um unico event loop em background supervisiona todos os processos
+loop = asyncio.new_event_loop()
 
-def verify_signature(req):
+def _pidfd_supported():
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        return True
+    except (AttributeError, OSError):
+        return False
+
+# o ThreadedChildWatcher padrao (3.8-3.11) cria uma thread waitpid por filho; com pidfd cada
+# processo vira so mais um fd no epoll do loop. No 3.12+ o asyncio ja escolhe pidfd sozinho.
+if sys.version_info < (3, 12) and _pidfd_supported():
+    _watcher = asyncio.PidfdChildWatcher()
+    asyncio.set_child_watcher(_watcher)
+    _watcher.attach_loop(loop)
+
+threading.Thread(target=loop.run_forever, name='orchestrator-loop', daemon=True).start()
+fetch_lock = None  # so o fetch e serializado; criado dentro do loop (no 3.9 o Lock se prende ao loop atual)
+# estado do debounce: so e tocado dentro do event loop, entao dispensa lock
+_pending_sha = None
+_debounce = None
+_running = set()
+LAST_HEAD_FILE = os.path.join(LOG_DIR, '.last_head')  # ultimo commit processado, sobrevive a restart
+_LAST_HEAD_LOCK = threading.Lock()
+_IN_FLIGHT = set()  # commits aceitos pelo webhook e ainda nao terminados (na janela ou rodando)
+
+def _read_last_head():
+    try:
+        with open(LAST_HEAD_FILE, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+_LAST_HEAD = _read_last_head()
+
+def record_last_head(commit_sha):
+    """Guarda o ultimo commit executado; None apaga (a ultima execucao falhou)."""
+    global _LAST_HEAD
+    with _LAST_HEAD_LOCK:
+        _LAST_HEAD = commit_sha
+    if commit_sha is None:
+        try:
+            os.remove(LAST_HEAD_FILE)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("last head remove failed:", e)
+        return
+    tmp = f"{LAST_HEAD_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(commit_sha)
+        os.replace(tmp, LAST_HEAD_FILE)
+    except OSError as e:
+        print("last head write failed:", e)
+
+def read_signed_body(req):
+    """Le o corpo direto do stream alimentando o HMAC; devolve o corpo se a assinatura bater, senao None."""
     header = req.headers.get('X-Hub-Signature-256')
     if header is None:
-        return False
-    sha_name, signature = header.split('=', 1)
-    if sha_name != 'sha256':
-        return False
-    mac = hmac.new(WEBHOOK_SECRET.encode(), msg=req.data, digestmod=hashlib.sha256)
-    return hmac.compare_digest(mac.hexdigest(), signature)
+        return None
+    sha_name, _, signature = header.partition('=')
+    if sha_name != 'sha256' or len(signature) != 64:
+        return None
+    # assinatura mal formada e rejeitada antes de gastar um SHA-256 no corpo inteiro
+    try:
+        expected = bytes.fromhex(signature)
+    except ValueError:
+        return None
+    length = req.content_length
+    if length is None or length > MAX_PAYLOAD:
+        return None
+    # buffer unico do tamanho do corpo: sem a copia extra do req.data
+    mac = hmac.new(WEBHOOK_SECRET_BYTES, digestmod='sha256')
+    body = bytearray(length)
+    view = memoryview(body)
+    got = 0
+    while got < length:
+        # read() e nao readinto(): sob gunicorn o stream e o Body cru, que nao tem readinto
+        chunk = req.stream.read(min(READ_CHUNK, length - got))
+        if not chunk:
+            break
+        mac.update(chunk)
+        view[got:got + len(chunk)] = chunk
+        got += len(chunk)
+    view.release()
+    if got != length or not hmac.compare_digest(mac.digest(), expected):
+        return None
+    return body
 
-def git_pull(repo_path):
-    with lock:
-        # pega branch atual
-        subprocess.run([GIT_BIN, 'fetch', '--all'], cwd=repo_path, check=True)
-        subprocess.run([GIT_BIN, 'reset', '--hard', 'origin/HEAD'], cwd=repo_path, check=True)
+async def run_git(repo_path, *args):
+    # '-C' em vez de cwd= e close_fds=False deixam o subprocess usar posix_spawn
+    # (os fds do Python ja nascem nao-herdaveis, entao nada vaza para o git)
+    proc = await asyncio.create_subprocess_exec(GIT_BIN, '-C', repo_path, *args, close_fds=False)
+    returncode = await proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, [GIT_BIN, *args])
+
+async def git_checkout(repo_path, commit_sha=None):
+    """Atualiza o repo e cria um worktree isolado no commit; devolve o caminho do worktree."""
+    global fetch_lock
+    if fetch_lock is None:
+        fetch_lock = asyncio.Lock()
+    async with fetch_lock:
+        await run_git(repo_path, 'fetch', '--prune', 'origin')
+    workdir = tempfile.mkdtemp(prefix='orquestra-')
+    try:
+        await run_git(repo_path, 'worktree', 'add', '--detach', workdir, commit_sha or 'origin/HEAD')
+    except Exception:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    return workdir
+
+async def remove_worktree(repo_path, workdir):
+    try:
+        await run_git(repo_path, 'worktree', 'remove', '--force', workdir)
+    except Exception as e:
+        print("git worktree remove failed:", e)
+        shutil.rmtree(workdir, ignore_errors=True)
+        try:
+            await run_git(repo_path, 'worktree', 'prune')
+        except Exception:
+            pass
+
+class Job(NamedTuple):
+    path: str
+    timeout: int = 60
+
+CONFIG_SIDECAR = os.path.join(LOG_DIR, f'.{CONFIG_FILE}.json')
+
+def _read_config(raw):
+    digest = hashlib.sha1(raw).hexdigest()
+    # sidecar json unico, com o sha1 do yaml dentro: json.loads e C puro, muito mais rapido que yaml
+    try:
+        with open(CONFIG_SIDECAR, 'rb') as f:
+            sidecar = json.loads(f.read())
+        if sidecar.get('digest') == digest:
+            return sidecar['config']
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass  # sidecar ausente/corrompido/de outra versao: cai para o yaml
+    cfg = yaml.load(raw, Loader=SafeLoader) or {}
+    try:
+        encoded = json.dumps({'digest': digest, 'config': cfg})
+    except (TypeError, ValueError):
+        return cfg
+    # so grava se o json reproduz o yaml fielmente (ex.: `on:` vira "true", chaves int viram str)
+    if json.loads(encoded)['config'] != cfg:
+        return cfg
+    tmp = f"{CONFIG_SIDECAR}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(encoded)
+        os.replace(tmp, CONFIG_SIDECAR)  # troca atomica
+    except OSError as e:
+        print("config sidecar write failed:", e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return cfg
+
+@functools.lru_cache(maxsize=16)
+def _parse_config(raw):
+    # cada push vem num worktree novo, entao a chave e o conteudo (caminho/mtime sempre mudam)
+    cfg = _read_config(raw)
+    # jobs viram uma tupla de Job validada uma vez so, em vez de dict.get a cada execucao
+    jobs = tuple(Job(j['path'], j.get('timeout', 60)) for j in cfg.get('jobs') or () if j.get('path'))
+    return {**cfg, 'jobs': jobs}
 
 def load_config(repo_path):
+    """Config do repo (jobs como tupla de Job). O dict devolvido e compartilhado pelo cache: trate como somente leitura."""
     cfg_path = os.path.join(repo_path, CONFIG_FILE)
-    if not os.path.exists(cfg_path):
+    try:
+        with open(cfg_path, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
         return {}
-    with open(cfg_path, 'r', encoding='utf-8') as f:
-        return yaml.safe_load(f) or {}
+    return _parse_config(raw)
 
-def run_script(repo_path, script_relpath, timeout=60):
+async def run_script(repo_path, script_relpath, timeout=60):
     script_path = os.path.join(repo_path, script_relpath)
     log_file = os.path.join(LOG_DIR, f"{os.path.basename(script_relpath)}_{int(time.time())}.log")
     start = time.time()
     try:
+        # o filho escreve direto no fd do log: o processo pai nao copia nem um byte da saida
         with open(log_file, 'wb') as out:
-            proc = subprocess.run(
-                [script_path],
+            proc = await asyncio.create_subprocess_exec(
+                script_path,
                 cwd=os.path.dirname(script_path),
                 stdout=out,
-                stderr=subprocess.STDOUT,
-                timeout=timeout,
-                check=False,
+                stderr=asyncio.subprocess.STDOUT,
             )
+        try:
+            returncode = await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return {'script': script_relpath, 'error': 'timeout', 'log': log_file}
         duration = time.time() - start
-        return {'script': script_relpath, 'returncode': proc.returncode, 'duration': duration, 'log': log_file}
-    except subprocess.TimeoutExpired:
-        return {'script': script_relpath, 'error': 'timeout', 'log': log_file}
+        return {'script': script_relpath, 'returncode': returncode, 'duration': duration, 'log': log_file}
     except Exception as e:
         return {'script': script_relpath, 'error': str(e), 'log': log_file}
 
-def orchestrate(repo_path, commit_sha=None):
+async def orchestrate(repo_path, commit_sha=None):
     try:
-        git_pull(repo_path)
+        workdir = await git_checkout(repo_path, commit_sha)
     except Exception as e:
-        print("git pull failed:", e)
+        print("git checkout failed:", e)
+        if commit_sha:
+            record_last_head(None)
         return
+    try:
+        results = await run_jobs(workdir)
+    finally:
+        await remove_worktree(repo_path, workdir)
+    # _LAST_HEAD e sempre a ultima execucao: se falhou, apaga (redelivery ou volta a um commit
+    # anterior roda de novo), em vez de deixar um commit antigo marcado como atual
+    if commit_sha:
+        ok = all(res.get('returncode') == 0 and 'error' not in res for res in results)
+        record_last_head(commit_sha if ok else None)
+    return results
 
-    cfg = load_config(repo_path)
+async def run_jobs(workdir):
+    cfg = load_config(workdir)
     # Exemplo de orchestrator.yaml:
     # jobs:
     #  - path: scripts/task1.sh
     #    timeout: 120
     #  - path: scripts/task2.py
-    jobs = cfg.get('jobs', [])
-    futures = []
+    tasks = [run_script(workdir, job.path, job.timeout) for job in cfg.get('jobs', ())]
     results = []
-    for job in jobs:
-        path = job.get('path')
-        timeout = job.get('timeout', 60)
-        if not path:
-            continue
-        futures.append(executor.submit(run_script, repo_path, path, timeout))
-    for fut in as_completed(futures):
-        res = fut.result()
+    for res in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(res, BaseException):
+            res = {'error': repr(res)}
         results.append(res)
         print("Job finished:", res)
     # aqui você pode enviar resultados para um dashboard, slack, banco etc.
     return results
 
+def _release(commit_sha):
+    with _LAST_HEAD_LOCK:
+        _IN_FLIGHT.discard(commit_sha)
+
+def _schedule(repo_path, commit_sha):
+    """Roda no loop: guarda o commit mais novo e agenda uma unica execucao por rajada."""
+    global _pending_sha, _debounce
+    superseded, _pending_sha = _pending_sha, commit_sha
+    if superseded and superseded != commit_sha:
+        _release(superseded)  # substituido por um push mais novo: nunca vai rodar
+    if _debounce is None:
+        _debounce = loop.call_later(DEBOUNCE_SECONDS, _fire, repo_path)
+
+def _fire(repo_path):
+    global _pending_sha, _debounce
+    commit_sha, _pending_sha, _debounce = _pending_sha, None, None
+    task = loop.create_task(orchestrate(repo_path, commit_sha=commit_sha))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    if commit_sha:
+        # so libera depois do orchestrate gravar o _LAST_HEAD: nao sobra janela para rodar duas vezes
+        task.add_done_callback(lambda _task: _release(commit_sha))
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    if not verify_signature(request):
+    body = read_signed_body(request)
+    if body is None:
         abort(400, 'Invalid signature')
-    payload = request.get_json()
     # opcional: filtrar por branch, por exemplo refs/heads/main
+    # busca em bytes antes do parse: push de outra branch e descartado sem decodificar o json
+    if b'refs/heads/main' not in body and b'refs/heads/master' not in body:
+        return 'ignored branch', 200
+    try:
+        payload = json_loads(body)  # orjson.JSONDecodeError herda de ValueError
+    except ValueError:
+        abort(400, 'Invalid JSON payload')
+    if not isinstance(payload, dict):
+        abort(400, 'Invalid JSON payload')
     ref = payload.get('ref', '')
     if 'refs/heads/main' not in ref and 'refs/heads/master' not in ref:
         return 'ignored branch', 200
 
-    # disparar orchestrate em background
-    executor.submit(orchestrate, REPO_PATH, commit_sha=payload.get('after'))
+    # commit ja processado (redelivery, push sem mudanca): nada a fazer
+    commit_sha = payload.get('after')
+    with _LAST_HEAD_LOCK:
+        if commit_sha and (commit_sha == _LAST_HEAD or commit_sha in _IN_FLIGHT):
+            return 'duplicate', 200
+        if commit_sha:
+            _IN_FLIGHT.add(commit_sha)
+
+    # disparar orchestrate em background (entregas quase simultaneas sao agrupadas)
+    loop.call_soon_threadsafe(_schedule, REPO_PATH, commit_sha)
     return 'ok', 200
 
 if __name__ == '__main__':
+    # servidor de desenvolvimento so com FLASK_DEV=1; em producao: gunicorn -c gunicorn_ini.conf.py _ini_:app
+    if not os.environ.get('FLASK_DEV'):
+        raise SystemExit("Use 'gunicorn -c gunicorn_ini.conf.py _ini_:app' (ou FLASK_DEV=1 para o servidor de desenvolvimento)")
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,9 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+worker_class = "gthread"
+# um worker só: os dois apps guardam estado no processo (repo escolhido em /set-repo,
+# página inicial, event loop e lock do fetch do _ini_.py); a concorrência vem das threads
+workers = 1
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = 60
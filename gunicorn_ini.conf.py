@@ -0,0 +1,11 @@
+# Configuracao do gunicorn para o orquestrador de orchestrator.yaml:
+#   gunicorn -c gunicorn_ini.conf.py _ini_:app
+# Porta propria (5000, como o app.run do _ini_.py) para nao colidir com o wsgi:app na 8000.
+import os
+
+bind = f"0.0.0.0:{os.getenv('INI_PORT', 5000)}"
+worker_class = "gthread"
+# um worker só: event loop, lock do fetch e debounce vivem no processo
+workers = 1
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = 60
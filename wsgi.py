@@ -0,0 +1,9 @@
+# Ponto de entrada WSGI para rodar em producao com gunicorn:
+#   gunicorn wsgi:app
+# (as opcoes ficam em gunicorn.conf.py: um worker gthread com varias threads, porta $PORT/8000)
+#
+# O orquestrador de orchestrator.yaml (_ini_.py) tem config e porta proprias ($INI_PORT/5000):
+#   gunicorn -c gunicorn_ini.conf.py _ini_:app
+from orquestrador import app
+
+__all__ = ["app"]